@@ -1,27 +1,35 @@
 import sys
 import os
 import os.path
-from os import path
+import mmap
+import struct
+import zlib
 import subprocess
 import numpy as np
 import pandas as pd
-import bgzip
 import gzip
-import csv
 import glob
+import re
 import pysam
-from collections import defaultdict
-from time import time
-from Bio import bgzf, SeqIO
 import toml
+import json
 import multiprocessing as mp
-from types import SimpleNamespace
+import threading
+import queue
 
 import dataclasses
 from simple_parsing import field
-from typing import Any, List, Tuple, Type, Union
+from typing import List
 import argparse
 
+#Optional ("fast" extra): pyarrow formats delimited text natively, much faster than 
+#DataFrame.to_csv. Only a missing pyarrow is tolerated, errors from a broken install propagate
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
 ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
 EXTRA_DIR = os.path.join(ROOT_DIR, "extra")
 
@@ -35,10 +43,120 @@ GENE_TABIX_COLS = TABIX_COLS + ["unique","universal"]
 GENE_TABIX_TYPES = {"start" : int, "end" : int, "unique" : int, "universal" : int}
 TABIX_SUFFIX = ".bgz"
 
+GFF_COLS = ["chr","source","type","start","end","score","strand","phase","attr"]
+GFF_TYPES = {"chr" : str, "type" : str, "start" : "int64", "end" : "int64", "attr" : str}
+
 REQUIRED_FILES = ["panagram.toml", "chrs.csv", "bins_*.bin", "anchors/*bgz", "anchors/*gzi"]
 
 MODES = {"r","w"}
 
+#Number of genomes packed into each KMC bitvector database (one bit per genome in a uint32 count)
+KMC_BITVEC_SIZE = 32
+
+#Number of set bits in each possible byte value
+POPCOUNT_LUT = np.array([bin(i).count("1") for i in range(256)], "uint8")
+
+#Number of k-mers present in exactly 1..ngenomes genomes. K-mers present in 
+#no genomes (e.g. containing N) are not counted in any column
+def count_occs(occs, ngenomes):
+    #bincount needs a type that safely casts to intp (occs are often uint64 sums)
+    occs = np.asarray(occs, "uint16" if ngenomes < 65536 else "uint32")
+    return np.bincount(occs, minlength=ngenomes+1)[1:].astype("uint32", copy=False)
+
+#Occurence counts (as in count_occs) for each interval [starts[i], ends[i]) of occs,
+#with every interval in a batch of up to max_len positions counted by one 2D bincount
+def count_interval_occs(occs, starts, ends, ngenomes, max_len=1<<24):
+    starts = np.clip(starts, 0, len(occs))
+    lens = np.clip(ends, starts, len(occs)) - starts
+    counts = np.zeros((len(starts), ngenomes), "uint32")
+    if len(starts) == 0:
+        return counts
+
+    #Intervals longer than max_len are counted in batches of their own
+    ends_cum = np.cumsum(lens)
+    batch_ids = (ends_cum-1) // max_len
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(batch_ids))+1, [len(starts)]])
+
+    n = ngenomes+1
+    for b0,b1 in zip(bounds[:-1], bounds[1:]):
+        blens = lens[b0:b1]
+        ids = np.repeat(np.arange(b1-b0), blens)
+        pos = np.arange(len(ids)) + np.repeat(starts[b0:b1] - (np.cumsum(blens)-blens), blens)
+        hist = np.bincount(ids*n + occs[pos], minlength=(b1-b0)*n)
+        counts[b0:b1] = hist.reshape((b1-b0, n))[:,1:]
+    return counts
+
+#Yields (name, sequence) for each record of a (optionally gzipped) FASTA file,
+#scanning large byte chunks for record boundaries instead of parsing line by line
+def iter_fasta(fname, chunk_size=1<<22):
+    def parse(rec):
+        i = rec.find(b"\n")
+        if i < 0:
+            i = len(rec)
+        names = rec[1:i].split(None, 1)
+        name = names[0].decode() if len(names) > 0 else ""
+        return name, rec[i+1:].translate(None, b" \t\r\n").decode("ascii")
+
+    opn = gzip.open if fname.endswith(".gz") or fname.endswith(".bgz") else open
+    with opn(fname, "rb") as fasta:
+        buf = bytearray()
+        while True:
+            chunk = fasta.read(chunk_size)
+            search = max(len(buf)-1, 0)
+            buf += chunk
+            end = buf.find(b"\n>", search)
+            while end >= 0:
+                #Anything before the first header is ignored
+                if buf.startswith(b">"):
+                    yield parse(buf[:end])
+                del buf[:end+1]
+                end = buf.find(b"\n>")
+            if not chunk:
+                break
+        if buf.startswith(b">"):
+            yield parse(buf)
+
+#Writes a DataFrame as headerless TSV, byte-for-byte the same as
+#df.to_csv(fname, sep="\t", header=None, index=False)
+def write_tsv(df, fname):
+    if pyarrow is not None:
+        try:
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+
+            #Other types (e.g. floats and bools) are formatted differently by pyarrow.
+            #Strings convert to large_string with pandas >= 3
+            is_str = lambda t: pyarrow.types.is_string(t) or pyarrow.types.is_large_string(t)
+            if all(pyarrow.types.is_integer(t) or is_str(t) for t in table.schema.types):
+                #Values which would need quoting raise ArrowInvalid, and are left to pandas
+                opts = pyarrow.csv.WriteOptions(include_header=False, delimiter="\t", quoting_style="none")
+                pyarrow.csv.write_csv(table, fname, opts)
+                return
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            pass
+
+    df.to_csv(fname, sep="\t", header=None, index=False)
+
+#json.dump default for configuration values which JSON can't encode directly:
+#numpy scalars and arrays, paths, and iterables such as sets, tuples and pd.Index
+def json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, os.PathLike):
+        return os.fspath(obj)
+    if hasattr(obj, "__iter__") and not isinstance(obj, (str, bytes)):
+        return [json_default(v) if isinstance(v, (np.generic, os.PathLike)) else v for v in obj]
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+#Compiled GFF attribute value patterns, shared by every query_genes call
+_ATTR_RES = dict()
+def attr_regex(attr):
+    pat = _ATTR_RES.get(attr, None)
+    if pat is None:
+        pat = _ATTR_RES[attr] = re.compile(f"{attr}=([^;]+)")
+    return pat
+
 @dataclasses.dataclass
 class KMC:
     """Parameters for KMC kmer counting"""
@@ -112,9 +230,16 @@ class Index:
         self.write()#args)
         self.close()
 
+    #Snapshot of the configuration, since asdict() deep-copies every field and params is
+    #passed to every worker. Retaken whenever the index sets its own configuration fields;
+    #changes made to the fields by callers are only seen after calling _update_params()
+    def _update_params(self):
+        self._params = dataclasses.asdict(self)
+
+    #Shallow copy of the snapshot. Nested values (e.g. "kmc") are shared and must not be modified
     @property
     def params(self):
-        return dataclasses.asdict(self)
+        return dict(self._params)
 
     def __post_init__(self):
 
@@ -134,6 +259,8 @@ class Index:
         if self.prefix is None:
             raise ValueError("Must specify index prefix or valid configuration file")
 
+        self._update_params()
+
         #self.write_mode = hasattr(self, "fasta")
         #for pattern in REQUIRED_FILES:
         #    if len(glob.glob(pattern)) == 0:
@@ -147,6 +274,7 @@ class Index:
         self.tmp_dir =    self.init_dir("tmp")
         self.anchor_dir = self.init_dir(ANCHOR_DIR)
         self.anno_dir = self.init_dir("anno")
+        self._tabix_prefix = os.path.join(self.anno_dir, "")
         self.mash_dir = self.init_dir("mash")
 
         if not self.write_mode:
@@ -155,7 +283,8 @@ class Index:
     def _init_read(self):
         self._load_chrs()
 
-        self._load_dict(self, toml.load(self.index_config_file))
+        self._load_dict(self, self._load_index_config())
+        self._update_params()
 
         self.bitmaps = dict()
         self.gene_tabix = dict()
@@ -171,16 +300,51 @@ class Index:
             if len(fnames) != 1:
                 raise RuntimeError(f"Exactly one chromosome bin file must be present, found {len(fnames)}: {fnames}")
             self.chr_bin_kbp = int(fnames[0].split("_")[-1][:-7])
+            self._update_params()
 
         self._load_chr_bins()
 
     def _load_chr_bins(self):
-        arr = np.fromfile(self.chr_bins_fname, "uint32")
-        arr = arr.reshape((len(arr)//self.ngenomes, self.ngenomes))
+        #Memory-mapped so multiple server processes share pages instead of copies
+        if os.path.getsize(self.chr_bins_fname) > 0:
+            arr = np.memmap(self.chr_bins_fname, "uint32", mode="r")
+        else:
+            arr = np.zeros(0, "uint32")
+        self.chr_bin_occs = arr.reshape((len(arr)//self.ngenomes, self.ngenomes))
+
+        #Bins are stored contiguously per chromosome in chrs.csv order
+        binlen = self.chr_bin_kbp*1000
+        self.chr_bin_counts = -(-np.clip(self.chrs["size"].to_numpy(), 0, None) // binlen)
+        self.chr_bin_offsets = np.cumsum(self.chr_bin_counts) - self.chr_bin_counts
 
-        idx = pd.MultiIndex.from_frame(pd.concat([self.chr_bin_coords(*ch).drop(columns=["end"]) for ch in self.chrs.index]))
-        self.chr_bins = pd.DataFrame(arr, columns=self._total_occ_idx, index=idx).sort_index()
-        #self.chr_bins = pd.read_pickle(self.chr_bins_fname)
+        totals = np.zeros((len(self.chrs), self.ngenomes), self.chr_bin_occs.dtype)
+        has_bins = self.chr_bin_counts > 0
+        if has_bins.any():
+            totals[has_bins] = np.add.reduceat(self.chr_bin_occs, self.chr_bin_offsets[has_bins], axis=0)
+        self.chr_bin_totals = pd.DataFrame(totals, index=self.chrs.index, columns=self._total_occ_idx)
+
+        self._chr_bins = None
+
+    #Raw (bins x ngenomes) occurence counts for one chromosome, without building chr_bins
+    def query_chr_bins(self, genome, chrom):
+        i = self.chrs.index.get_loc((genome,chrom))
+        st = self.chr_bin_offsets[i]
+        return self.chr_bin_occs[st:st+self.chr_bin_counts[i]]
+
+    #DataFrame of chr_bin_occs indexed by (genome, chr, start), built on first access
+    @property
+    def chr_bins(self):
+        if self._chr_bins is None:
+            #Equivalent to concatenating chr_bin_coords() for every chromosome
+            binlen = self.chr_bin_kbp*1000
+            bin_offs = np.repeat(self.chr_bin_offsets, self.chr_bin_counts)
+            idx = pd.MultiIndex.from_arrays([
+                self.chrs.index.get_level_values("genome").repeat(self.chr_bin_counts),
+                self.chrs.index.get_level_values("chr").repeat(self.chr_bin_counts),
+                (np.arange(len(bin_offs)) - bin_offs) * binlen
+            ], names=["genome","chr","start"])
+            self._chr_bins = pd.DataFrame(self.chr_bin_occs, columns=self._total_occ_idx, index=idx).sort_index()
+        return self._chr_bins
 
     def init_dir(self, path):
         d = os.path.join(self.prefix, path)
@@ -213,7 +377,7 @@ class Index:
         return bitmap.anchor_name
 
     def _load_chrs(self):
-        self.chrs = pd.read_csv(f"{self.prefix}/chrs.csv").set_index(["genome","chr"])
+        self.chrs = pd.read_csv(f"{self.prefix}/chrs.csv", index_col=["genome","chr"], dtype={"genome" : str, "chr" : str})
         names = self.chrs.columns.str
 
         total_cols = names.startswith("total_occ_")
@@ -224,22 +388,22 @@ class Index:
         self.chr_occ.columns = cols.set_levels(cols.levels[1].astype(int), level=1)
 
         self.genome_occ = self.chr_occ.groupby(level="genome", sort=False).sum()
-        normalize = lambda df: df.divide(df.sum(axis=1), axis=0)
-        
-        self.genome_occ_freq = pd.concat({
-            "total" : normalize(self.genome_occ["total"]),
-            "gene" : normalize(self.genome_occ["gene"]),
-        }, axis=1)
-        
-        self.chr_occ_freq = pd.concat({
-            "total" : normalize(self.chr_occ["total"]),
-            "gene" : normalize(self.chr_occ["gene"]),
-        }, axis=1)
+
+        #Normalize "total" and "gene" counts separately in a single pass over each table
+        def normalize(df):
+            sums = df.T.groupby(level=0, sort=False).sum().T
+            return df.div(sums, level=0)
+
+        self.genome_occ_freq = normalize(self.genome_occ)
+        self.chr_occ_freq = normalize(self.chr_occ)
 
         self._init_genomes()
 
-        self.genome_occ_avg = (self.genome_occ_freq["total"]*self._occ_idx).sum(axis=1).sort_values()
-        self.chr_occ_avg = (self.chr_occ_freq["total"]*self._occ_idx).sum(axis=1).sort_values()
+        #Weighted average of occurence counts. NaN rows (genomes without k-mers) average to 0
+        occs = self._occ_idx.to_numpy()
+        occ_avg = lambda freq: pd.Series(np.nan_to_num(freq["total"].to_numpy()) @ occs, index=freq.index).sort_values()
+        self.genome_occ_avg = occ_avg(self.genome_occ_freq)
+        self.chr_occ_avg = occ_avg(self.chr_occ_freq)
 
     @property
     def genome_occs():
@@ -249,6 +413,7 @@ class Index:
         self.genomes = self.chrs.index.unique("genome")
         if self.anchor_genomes is None:
             self.anchor_genomes = self.chrs.query("size > 0").index.unique("genome")
+            self._update_params()
         self.ngenomes = len(self.genomes)
 
         g = self.chrs["size"].groupby("genome")
@@ -288,7 +453,7 @@ class Index:
         return os.path.join(self.prefix, "genome_dist.tsv")
 
     def write(self):
-        genomes = list()
+        chr_rows = list()
         self.genome_ids = dict()
         self.genome_files = pd.DataFrame({
             "fasta" : pd.Series(self.fasta),
@@ -319,17 +484,14 @@ class Index:
                         subprocess.check_call(cmd)
                     fa = pysam.FastaFile(fasta)
 
-                    genomes.append(pd.DataFrame(
-                        [(name, chrom, genome_id, fa.get_reference_length(chrom)-self.k+1) 
-                         for chrom in fa.references], 
-                        columns=["genome", "chr", "id", "size"]))
+                    chr_rows += [(name, chrom, genome_id, length-self.k+1) 
+                                 for chrom,length in zip(fa.references, fa.lengths)]
+                    fa.close()
 
                 else:
-                    genomes.append(pd.DataFrame(
-                        {"genome" : [name], "id" : genome_id, "chr" : None, "size" : 0}
-                    ))
+                    chr_rows.append((name, None, genome_id, 0))
 
-            self.chrs = pd.concat(genomes).set_index(["genome", "chr"])
+            self.chrs = pd.DataFrame(chr_rows, columns=["genome", "chr", "id", "size"]).set_index(["genome", "chr"])
             self._init_genomes()
             #self.chrs.to_csv(f"{self.prefix}/chrs.csv")
             self._write_chrs()
@@ -359,39 +521,28 @@ class Index:
                         print(f"Anchored {name}")
                         sys.stdout.flush()
 
-        self.bitmaps = {
-            name : KmerBitmap(self.params, name, "r", self.chrs) for name in self.anchor_genomes
-        }
-
         print("Computing chromosome summaries")
-        self.chrs[self._total_occ_idx] = 0
-        self.chrs[self._gene_occ_idx] = 0
-
-        chr_bins_out = open(self.chr_bins_fname, "wb")
-        #bin_coords = list()
-        #chr_bin_occs = list()
-
-        prev_genome = None
-        for (genome,chrom),size in self.chrs["size"].items():
-            if size == 0: 
-                continue
-
-            if genome != prev_genome:
-                prev_genome = genome
-
-            occs = self.query_bitmap(genome,chrom,0,size,100).sum(axis=1)
-            chr_counts = self.count_occs(occs)
-            self.chrs.loc[(genome,chrom), self._total_occ_idx] = chr_counts
+        #Same dtype as the counts, so assigning and accumulating them never upcasts
+        occ_cols = self._total_occ_idx.append(self._gene_occ_idx)
+        self.chrs[occ_cols] = np.zeros((len(self.chrs), len(occ_cols)), "uint32")
 
-            coords = self.chr_bin_coords(genome,chrom)
+        #Bins are written in chrs.csv order, so results must be consumed in order
+        def iter_summary_args():
+            for name in self.chrs.query("size > 0").index.unique("genome"):
+                yield (self.params, name, self.chrs)
 
-            for i,c in coords.iterrows():
-                st = c["start"] // self.lowres_step
-                en = c["end"] // self.lowres_step
-                bin_counts = self.count_occs(occs[st:en])
-                chr_bins_out.write(bin_counts.tobytes())
+        with open(self.chr_bins_fname, "wb") as chr_bins_out:
+            if self.processes == 1:
+                for args in iter_summary_args():
+                    self._write_summary(chr_bins_out, *self.run_summary(args))
+            else:
+                with mp.Pool(processes=self.processes) as pool:
+                    for summary in pool.imap(self.run_summary, iter_summary_args(), chunksize=1):
+                        self._write_summary(chr_bins_out, *summary)
 
-        chr_bins_out.close()
+        #Only opened on demand for gene summaries, after the summary pool has finished
+        #so no open readers are inherited by forked workers
+        self.bitmaps = dict()
 
         #self.chrs.to_csv(f"{self.prefix}/chrs.csv")
         self._write_chrs()
@@ -405,12 +556,13 @@ class Index:
                 self.all_anno_types = pd.Index([])
 
             print("Computing gene summaries")
-            for g in self.genomes:
+            for g in self.anchor_genomes:
                 print(g)
                 self._load_gffs(g)
 
             if self.gff_anno_types is None:
                 self.gff_anno_types = list(self.all_anno_types)
+                self._update_params()
 
         #self.chrs.to_csv(f"{self.prefix}/chrs.csv")
         self._write_chrs()
@@ -418,10 +570,68 @@ class Index:
         with open(self.index_config_file, "w") as conf_out:
             toml.dump(self.params, conf_out)
 
+        #Written after the toml so it is never older than the configuration it mirrors
+        with open(self.index_config_json, "w") as conf_out:
+            json.dump(self.params, conf_out, default=json_default)
+
+    @staticmethod
+    def run_summary(args):
+        conf, genome, chrs = args
+        bitmap = KmerBitmap(conf, genome, "r", chrs)
+
+        step = conf["lowres_step"]
+        binlen = conf["chr_bin_kbp"]*1000
+
+        #All of the genome's bins are filled into one array, in the order they are written
+        nbins = -(-np.clip(bitmap.sizes.to_numpy(), 0, None) // binlen)
+        bin_offsets = np.cumsum(nbins) - nbins
+        chr_counts = np.zeros((len(nbins), bitmap.ngenomes), "uint32")
+        bin_counts = np.zeros((nbins.sum(), bitmap.ngenomes), "uint32")
+
+        for ci,(chrom,size) in enumerate(bitmap.sizes.items()):
+            #Sequences shorter than k have no k-mers (and non-positive sizes)
+            if size <= 0:
+                continue
+
+            occs = bitmap.query_occs(chrom,0,size,step)
+
+            #Bins tile occs contiguously, so every bin is counted with one 2D bincount
+            bin_starts = np.arange(0, size, binlen)
+            bin_ends = np.minimum(bin_starts+binlen, size) // step
+            bin_starts //= step
+            n = bitmap.ngenomes+1
+            bins = bin_counts[bin_offsets[ci]:bin_offsets[ci]+nbins[ci]]
+            bin_ids = np.repeat(np.arange(nbins[ci]), bin_ends - bin_starts)
+            hist = np.bincount(bin_ids*n + occs[:bin_ends[-1]], minlength=nbins[ci]*n)
+            bins[:] = hist.reshape((nbins[ci], n))[:,1:]
+
+            #The bins cover every k-mer, so the chromosome totals are their column sums
+            chr_counts[ci] = bins.sum(axis=0, dtype="uint32")
+
+        bitmap.close()
+        return genome, chr_counts, bin_counts
+
+    def _write_summary(self, chr_bins_out, genome, chr_counts, bin_counts):
+        self.chrs.loc[genome, self._total_occ_idx] = chr_counts
+        chr_bins_out.write(bin_counts.tobytes())
+
     @property
     def index_config_file(self):
         return f"{self.prefix}/panagram.toml"
 
+    #JSON copy of index_config_file, which is much faster to parse
+    @property
+    def index_config_json(self):
+        return f"{self.prefix}/panagram.json"
+
+    def _load_index_config(self):
+        #Fall back to the toml if the JSON copy is missing or the toml was edited after it was written
+        if (os.path.exists(self.index_config_json) and
+                os.path.getmtime(self.index_config_json) >= os.path.getmtime(self.index_config_file)):
+            with open(self.index_config_json) as conf_in:
+                return json.load(conf_in)
+        return toml.load(self.index_config_file)
+
     @property
     def chr_bins_fname(self):
         return f"{self.prefix}/bins_{self.chr_bin_kbp}kbp.bin"
@@ -435,22 +645,18 @@ class Index:
         return ret
 
     def query_occ_counts(self, genome, chrom, start, end, step=1):
-        occs = self.query_bitmap(genome, chrom, start, end, step).sum(axis=1)
+        occs = self.query_occs(genome, chrom, start, end, step)
         return self.count_occs(occs)
     
     def count_occs(self, occs):
-        ret = np.zeros(self.ngenomes, "uint32")
-        occs, counts = np.unique(occs, return_counts=True)
-        ret[occs-1] = counts
-        return ret
+        return count_occs(occs, self.ngenomes)
         #return pd.Series(index=idx[occs-1], data=counts).reindex(idx, fill_value=0)
 
     def _iter_gff(self, fname):
         for df in pd.read_csv(
             fname, 
-            sep="\t", comment="#", chunksize=10000,
-            names = ["chr","source","type","start","end","score","strand","phase","attr"],
-            usecols = TABIX_COLS): yield df[TABIX_COLS]
+            sep="\t", comment="#", chunksize=200000, engine="c", na_filter=False,
+            names = GFF_COLS, usecols = TABIX_COLS, dtype = GFF_TYPES): yield df[TABIX_COLS]
 
     def _load_tabix(self, genome, type_):
         fname = self.tabix_fname(genome, type_)
@@ -480,13 +686,13 @@ class Index:
         out.to_csv(f"{self.prefix}/chrs.csv")
 
     def tabix_fname(self, genome, typ):
-        return os.path.join(self.anno_dir, f"{genome}.{typ}.bed{TABIX_SUFFIX}") 
+        return f"{self._tabix_prefix}{genome}.{typ}.bed{TABIX_SUFFIX}"
 
     def _write_tabix(self, df, genome, typ):
         tbx = self.tabix_fname(genome, typ)
         bed = tbx[:-len(TABIX_SUFFIX)]
 
-        df.to_csv(bed, sep="\t", header=None, index=False)
+        write_tsv(df, bed)
         pysam.tabix_compress(bed, tbx, True)
         pysam.tabix_index(tbx, True, 0,1,2, csi=True)
         #os.remove(bed)
@@ -497,6 +703,9 @@ class Index:
         fname = self.genome_files.loc[genome, "gff"]
         if pd.isna(fname): return
 
+        if genome not in self.bitmaps:
+            self.bitmaps[genome] = KmerBitmap(self.params, genome, "r", self.chrs)
+
         for df in self._iter_gff(fname):
             gmask = df["type"].isin(self.gff_gene_types)
             genes.append(df[gmask])
@@ -516,19 +725,47 @@ class Index:
             self.all_anno_types = self.all_anno_types.union(annos["type"].unique())
 
         genes = _merge_dfs(genes)
-        genes["unique"] = 0
-        genes["universal"] = 0
-        for i,g in genes.iterrows():
-            counts = self.query_occ_counts(genome, g["chr"], g["start"], g["end"])
-            genes.loc[i, "unique"] += counts[0]
-            genes.loc[i, "universal"] += counts[-1]
-            self.chrs.loc[(genome,g["chr"]), self._gene_occ_idx] += counts
-            #for occ,count in counts.items():
-            #    self.chrs.loc[(genome,g["chr"]), occ] += count
+
+        #Genes are counted into one dense (genes x ngenomes) matrix
+        #which is only attached to the genes table at the end
+        counts = np.zeros((len(genes), self.ngenomes), "uint32")
+        starts = genes["start"].to_numpy()
+        ends = genes["end"].to_numpy()
+        for chrom,rows in genes.groupby("chr", sort=False).indices.items():
+            counts[rows] = self._count_gene_occs(genome, chrom, starts[rows], ends[rows])
+            self.chrs.loc[(genome,chrom), self._gene_occ_idx] += counts[rows].sum(axis=0, dtype="uint32")
+
+        genes["unique"] = counts[:,0]
+        genes["universal"] = counts[:,-1]
 
         self._write_tabix(genes, genome, "gene")
 
 
+    #Occurence counts for each gene [starts[i], ends[i]) of one chromosome. Genes are 
+    #grouped into windows spanning at most max_len k-mers, and only each window's k-mers 
+    #are read, so neither sparse genes nor large chromosomes require reading the whole chromosome
+    def _count_gene_occs(self, genome, chrom, starts, ends, max_len=1<<24):
+        size = max(self.chrs.loc[(genome,chrom),"size"], 0)
+        order = np.argsort(starts, kind="stable")
+        starts = np.clip(starts[order], 0, size)
+        ends = np.clip(ends[order], starts, size)
+
+        counts = np.zeros((len(starts), self.ngenomes), "uint32")
+        i = 0
+        while i < len(starts):
+            wst = starts[i]
+            wen = ends[i]
+            j = i+1
+            while j < len(starts) and max(wen, ends[j]) - wst <= max_len:
+                wen = max(wen, ends[j])
+                j += 1
+
+            occs = self.query_occs(genome, chrom, wst, wen)
+            counts[order[i:j]] = count_interval_occs(occs, starts[i:j]-wst, ends[i:j]-wst, self.ngenomes)
+            i = j
+
+        return counts
+
     def close(self):
         for b in self.bitmaps.values():
             b.close()
@@ -537,6 +774,9 @@ class Index:
     def query_bitmap(self, genome, chrom, start=None, end=None, step=1):
         return self.bitmaps[genome].query(chrom, start, end, step)
 
+    def query_occs(self, genome, chrom, start=None, end=None, step=1):
+        return self.bitmaps[genome].query_occs(chrom, start, end, step)
+
     def query_genes(self, genome, chrom, start, end, attrs=["Name"]):
         if self.gene_tabix.get(genome, None) is None:
             return pd.DataFrame(columns=GENE_TABIX_COLS)
@@ -566,7 +806,7 @@ class Index:
         #sys.stderr.flush()
         #sys.stdout.flush()
         for a in attrs:
-            ret[a.lower()] = ret["attr"].str.extract(f"{a}=([^;]+)")
+            ret[a.lower()] = ret["attr"].str.extract(attr_regex(a))
         
         return ret
 
@@ -618,69 +858,63 @@ class Index:
         return db_i, name, onehot_db
 
 
+    #Genome names split into consecutive groups of KMC_BITVEC_SIZE, one group per bitvector DB
+    def _kmc_genome_groups(self):
+        names = self.genome_files.index.to_numpy()
+        return np.array_split(names, np.arange(KMC_BITVEC_SIZE, len(names), KMC_BITVEC_SIZE))
+
     def _iter_kmc_genome_args(self):
-        i = 0
-        db_i = 0
-        #for name,fasta in self.genome_files["fasta"].items():
-        for name,(fasta,fastq) in self.genome_files[["fasta", "fastq"]].iterrows():
-            fasta_in = pd.isnull(fastq)
-            if not fasta_in:
-                fasta = fastq
-
-            if i >= 32:
-                i = 0
-                db_i += 1
-
-            count_db = os.path.join(self.count_dir, name)
-            onehot_db = os.path.join(self.onehot_dir, name)
-            tmp_dir = self.init_dir(f"tmp/{name}")
-            yield (self.params, db_i, i, name, fasta, count_db, onehot_db, tmp_dir, fasta_in)
-
-            i += 1
+        for db_i,group in enumerate(self._kmc_genome_groups()):
+            for i,name in enumerate(group):
+                fasta,fastq = self.genome_files.loc[name, ["fasta", "fastq"]]
+                fasta_in = pd.isnull(fastq)
+                if not fasta_in:
+                    fasta = fastq
+
+                count_db = os.path.join(self.count_dir, name)
+                onehot_db = os.path.join(self.onehot_dir, name)
+                tmp_dir = self.init_dir(f"tmp/{name}")
+                yield (self.params, db_i, i, name, fasta, count_db, onehot_db, tmp_dir, fasta_in)
     
     @property
     def kmc_bitvec_count(self):
-        return int(np.ceil(self.ngenomes / 32.0))
+        return int(np.ceil(self.ngenomes / KMC_BITVEC_SIZE))
 
-    def _run_kmc(self):
+    #Write the kmc_tools "complex" definition summing one group of one-hot genome DBs
+    def _write_opdef(self, i, genome_dbs):
+        opdef_fname = os.path.join(self.bitvec_dir, f"{i}.opdef.txt")
+        bitvec_fname = os.path.abspath(os.path.join(self.bitvec_dir, f"{i}"))
 
-        i = 0
+        names = [name for name,_ in genome_dbs]
+        opdef = "".join(
+            ["INPUT:\n"] +
+            [f"{name} = {db}\n" for name,db in genome_dbs] +
+            [f"OUTPUT:\n{bitvec_fname} = ", " + ".join(names), "\n-ocsum\n"])
+
+        with open(opdef_fname, "w") as opdefs:
+            opdefs.write(opdef)
+
+        return opdef_fname, bitvec_fname
+
+    def _run_kmc(self):
         samp_count = len(self.genome_files)
-        kmc_bitvec_count = int(np.ceil(samp_count / 32))
 
-        genome_dbs = [list() for i in range(kmc_bitvec_count)]
+        genome_dbs = [list() for _ in self._kmc_genome_groups()]
         if self.kmc.processes == 1:
             for args in self._iter_kmc_genome_args():
                 i,name,db = self._run_kmc_genome(args)
                 genome_dbs[i].append((name,db))
         else:
+            #Output order only affects the order of terms in the opdef files
+            chunksize = max(1, samp_count // (4*self.kmc.processes))
             with mp.Pool(processes=self.kmc.processes) as pool:
-                for i,name,db in pool.imap(self._run_kmc_genome, self._iter_kmc_genome_args(), chunksize=1):
+                for i,name,db in pool.imap_unordered(self._run_kmc_genome, self._iter_kmc_genome_args(), chunksize=chunksize):
                     genome_dbs[i].append((name,db))
 
         bitvec_dbs = list()
 
-        for i in range(kmc_bitvec_count):
-            h = (i+1)*32
-
-            if kmc_bitvec_count == 1 or i < kmc_bitvec_count:
-                t=32
-            else:
-                t = samp_count-32
-
-            opdef_fname = os.path.join(self.bitvec_dir, f"{i}.opdef.txt")
-            bitvec_fname = os.path.abspath(os.path.join(self.bitvec_dir, f"{i}"))
-
-            with open(opdef_fname, "w") as opdefs:
-                opdefs.write("INPUT:\n")
-                for name, db in genome_dbs[i]:
-                    opdefs.write(f"{name} = {db}\n")
-                opdefs.write(f"OUTPUT:\n{bitvec_fname} = {genome_dbs[i][0][0]}")
-                for name,_ in genome_dbs[i][1:]:
-                    opdefs.write(f" + {name}")
-                opdefs.write("\n-ocsum\n")
-
-            opdefs.close()
+        for i in range(len(genome_dbs)):
+            opdef_fname, bitvec_fname = self._write_opdef(i, genome_dbs[i])
 
             subprocess.check_call([
                 f"{EXTRA_DIR}/kmc_tools", "complex", opdef_fname
@@ -689,6 +923,171 @@ class Index:
             bitvec_dbs.append(bitvec_fname)
         return bitvec_dbs
 
+#Returns (XLEN, total block size) from the header of the BGZF block starting at offs
+def bgzf_block_size(buf, offs):
+    xlen, = struct.unpack_from("<H", buf, offs+10)
+    i = offs + 12
+    while i < offs + 12 + xlen:
+        si1, si2, slen = struct.unpack_from("<BBH", buf, i)
+        if si1 == 66 and si2 == 67:
+            bsize, = struct.unpack_from("<H", buf, i+4)
+            return xlen, bsize+1
+        i += 4 + slen
+    raise ValueError(f"Invalid BGZF block at offset {offs}")
+
+class BgzfIndexWriter:
+    """Output file for a BGZF writer which records the compressed and uncompressed 
+    offset of each block as it is written, then writes the .gzi index on close. 
+    Equivalent to running "bgzip -rI" on the finished file, without re-reading it"""
+
+    def __init__(self, fname, idx_fname):
+        self.idx_fname = idx_fname
+        self._file = open(fname, "wb")
+
+        #Bytes written which do not yet form a complete block
+        self._pending = bytearray()
+        self._rstart = 0
+        self._dstart = 0
+        self._blocks = list()
+
+    def write(self, data):
+        self._file.write(data)
+        self._pending += data
+
+        offs = 0
+        while len(self._pending) - offs >= 18:
+            xlen, size = bgzf_block_size(self._pending, offs)
+            if len(self._pending) - offs < size:
+                break
+            isize, = struct.unpack_from("<I", self._pending, offs+size-4)
+
+            #Like htslib, the first block and empty (e.g. EOF) blocks have no entry
+            if isize > 0 and self._rstart > 0:
+                self._blocks.append((self._rstart, self._dstart))
+
+            self._rstart += size
+            self._dstart += isize
+            offs += size
+
+        del self._pending[:offs]
+        return len(data)
+
+    def flush(self):
+        self._file.flush()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+
+        if len(self._pending) > 0:
+            raise ValueError(f"Incomplete BGZF block at end of {self._file.name}")
+
+        with open(self.idx_fname, "wb") as idx_out:
+            np.array([len(self._blocks)], "uint64").tofile(idx_out)
+            np.array(self._blocks, "uint64").reshape((-1, 2)).tofile(idx_out)
+
+class BgzfBlockReader:
+    """Random access reader for BGZF files which memory-maps the file and 
+    decompresses only the blocks covering each read, located via the .gzi index"""
+
+    def __init__(self, fname, blocks):
+        self.blocks = blocks
+        self._file = open(fname, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        #Most recently decompressed block (index, start, data), shared by sequential reads
+        self._cache = (None, None, None)
+
+    def _read_block(self, blk):
+        cached_blk, _, data = self._cache
+        if cached_blk == blk:
+            return data
+
+        offs = int(self.blocks["rstart"][blk])
+        xlen, size = bgzf_block_size(self._mmap, offs)
+        data = zlib.decompress(self._mmap[offs+12+xlen : offs+size-8], -15)
+
+        self._cache = (blk, int(self.blocks["dstart"][blk]), data)
+        return data
+
+    def read(self, start, length):
+        #Sequential reads usually start in the cached block, which avoids the search
+        blk, dstart, data = self._cache
+        if blk is None or not (dstart <= start < dstart + len(data)):
+            blk = np.searchsorted(self.blocks["dstart"], start, side="right")-1
+            dstart = self.blocks["dstart"][blk]
+        offs = int(start - dstart)
+
+        chunks = list()
+        while length > 0 and blk < len(self.blocks):
+            chunk = self._read_block(blk)[offs:offs+length]
+            chunks.append(chunk)
+            length -= len(chunk)
+            offs = 0
+            blk += 1
+
+        if len(chunks) == 1:
+            return chunks[0]
+        return b"".join(chunks)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+class ThreadedWriter:
+    """Wraps a writer (e.g. bgzip.BGZipWriter) so writes are queued and performed 
+    by a background thread, overlapping compression with the caller's work"""
+
+    def __init__(self, writer, maxsize=4):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            #Keep draining the queue after an error so write() never blocks
+            if self._error is None:
+                try:
+                    self.writer.write(data)
+                except Exception as e:
+                    self._error = e
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, data):
+        #Nothing drains the queue once the thread exits, so put() would block
+        if self._closed or not self._thread.is_alive():
+            raise ValueError("I/O operation on closed ThreadedWriter")
+        self._check_error()
+        self._queue.put(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        #The wrapped writer is closed (e.g. writing the BGZF EOF block) even after a failed write
+        try:
+            if self._thread.is_alive():
+                self._queue.put(None)
+                self._thread.join()
+        finally:
+            self.writer.close()
+        self._check_error()
+
 class KmerBitmap:
     def __init__(self, conf, anchor, mode="r", chrs=None, fasta=None, kmc_dbs=None):
         self.conf = conf
@@ -703,12 +1102,19 @@ class KmerBitmap:
         self.nbytes = int(np.ceil(self.ngenomes / 8))
         self.bitmaps = None
 
+        #Popcounts for the last byte of each row, ignoring padding bits past ngenomes.
+        #Stored as uint32 so the gather directly produces the query_occs result
+        self._popcount_last = POPCOUNT_LUT[np.arange(256) & ((1 << (self.ngenomes % 8 or 8)) - 1)].astype("uint32")
+
         self._init_steps(conf)
-        step_sizes = pd.DataFrame({step : np.ceil(self.sizes / step) for step in self.steps}, dtype=int)
-        self.offsets = step_sizes.cumsum().shift(fill_value=0) 
+        #Rows per (chromosome, step) via integer ceil division, and each chromosome's starting row
+        step_sizes = -(-self.sizes.to_numpy("int64")[:,None] // np.asarray(self.steps, "int64"))
+        offsets = np.zeros_like(step_sizes)
+        np.cumsum(step_sizes[:-1], axis=0, out=offsets[1:])
+        self.offsets = pd.DataFrame(offsets, index=self.sizes.index, columns=self.steps)
 
-        self.seq_lens = defaultdict(dict)
-        self.bitmap_lens = defaultdict(int)
+        #Number of bitmap rows written for each (chromosome, step)
+        self.seq_lens = np.zeros((len(self.sizes), len(self.steps)), "int64")
 
         if mode == "w":
             if self.conf["use_existing_anchors"]:
@@ -732,9 +1138,13 @@ class KmerBitmap:
             self.steps = [1, conf["lowres_step"]]
         else:
             self.steps = list()
-            for fname in glob.glob(f"{self.prefix}.*.{BGZ_SUFFIX}"):
-                step = int(fname.split(".")[-2])
-                self.steps.append(step)
+            anchor_dir, anchor_file = os.path.split(self.prefix)
+            step_re = re.compile(rf"^{re.escape(anchor_file)}\.(\d+)\.{re.escape(BGZ_SUFFIX)}$")
+            with os.scandir(anchor_dir or ".") as entries:
+                for entry in entries:
+                    m = step_re.match(entry.name)
+                    if m is not None:
+                        self.steps.append(int(m.group(1)))
 
     def bgz_fname(self, step): 
         return f"{self.prefix}.{step}.{BGZ_SUFFIX}"
@@ -748,9 +1158,11 @@ class KmerBitmap:
 
     def _init_read(self):
         self.write_mode = False
+        if self.bitmaps is not None:
+            return
 
         self.blocks = {s : self.load_bgz_blocks(self.idx_fname(s)) for s in self.steps}
-        self.bitmaps = {s : bgzf.BgzfReader(self.bgz_fname(s), "rb") for s in self.steps}
+        self.bitmaps = {s : BgzfBlockReader(self.bgz_fname(s), self.blocks[s]) for s in self.steps}
 
     @property
     def chrs(self):
@@ -759,6 +1171,11 @@ class KmerBitmap:
     def seq_len(self, seq_name):
         return self.sizes.loc[seq_name]
 
+    #Total number of bitmap rows written for each step
+    @property
+    def bitmap_lens(self):
+        return pd.Series(self.seq_lens.sum(axis=0), index=self.steps)
+
     def load_bgz_blocks(self, fname):
         idx_in = open(fname, "rb")
         nblocks = np.fromfile(idx_in, "uint64", 1)[0]
@@ -768,6 +1185,23 @@ class KmerBitmap:
         return blocks.astype([("rstart", int), ("dstart", int)])
 
     def query(self, name, start=None, end=None, step=1):
+        return self._bytes_to_bits(self._query_packed(name, start, end, step))
+
+    #Expand packed rows to one column per genome. np.unpackbits is already table-driven,
+    #and measured faster than gathering from a (256, 8) bit lookup table
+    def _bytes_to_bits(self, pac):
+        return np.unpackbits(pac, bitorder="little", axis=1)[:,:self.ngenomes]
+
+    #Number of genomes containing each k-mer, equivalent to query(...).sum(axis=1)
+    #but computed directly from the packed bytes
+    def query_occs(self, name, start=None, end=None, step=1):
+        pac = self._query_packed(name, start, end, step)
+        occs = self._popcount_last[pac[:,-1]]
+        if self.nbytes > 1:
+            occs += POPCOUNT_LUT[pac[:,:-1]].sum(axis=1, dtype="uint32")
+        return occs
+
+    def _query_packed(self, name, start, end, step):
         bstep = 1
         for s in self.steps:
             if step % s == 0:
@@ -779,11 +1213,7 @@ class KmerBitmap:
         if end is None:
             end = self.seq_len(name)
 
-        pac = self._query(name, start, end, step, bstep)
-
-        ret = np.unpackbits(pac, bitorder="little", axis=1)[:,:self.ngenomes]
-
-        return ret
+        return self._query(name, start, end, step, bstep)
 
     def _query(self, name, start, end, step, bstep):
         byte_start = self.nbytes * (self.offsets.loc[name,bstep] + (start//bstep))
@@ -791,12 +1221,7 @@ class KmerBitmap:
 
         step = step // bstep
 
-        blk = np.searchsorted(self.blocks[bstep]["dstart"], byte_start, side="right")-1
-        blk_offs = byte_start - self.blocks[bstep]["dstart"][blk]
-        blk_start = self.blocks[bstep]["rstart"][blk]
-
-        self.bitmaps[bstep].seek(bgzf.make_virtual_offset(blk_start, blk_offs))
-        buf = self.bitmaps[bstep].read(length * self.nbytes)
+        buf = self.bitmaps[bstep].read(byte_start, length * self.nbytes)
 
         pac = np.frombuffer(buf, "uint8").reshape((len(buf)//self.nbytes, self.nbytes))
 
@@ -811,7 +1236,14 @@ class KmerBitmap:
         vec = self.kmc.CountVec()
         db.GetCountersForRead(seq, vec)
 
-        pac = np.array(vec, dtype="uint32")
+        #Wrap the vector's memory directly if py_kmc_api exposes the buffer protocol,
+        #otherwise copy it without np.array's generic sequence conversion
+        try:
+            pac = np.frombuffer(vec, "uint32")
+        except TypeError:
+            pac = np.fromiter(vec, "uint32", len(vec))
+
+        #Byte columns are a view, and are copied straight into the row buffer by the caller
         return pac.view("uint8").reshape((len(pac),4))
     
     def _load_kmc(self, kmc_dbs):
@@ -830,72 +1262,46 @@ class KmerBitmap:
                 self.kmc_dbs.append(db)
 
     def _init_write(self, kmc_dbs=None):
-        self._load_kmc(kmc_dbs)
-
-        #self.bitmaps = {s : bgzf.BgzfWriter(self.bgz_fname(s), "wb") for s in self.steps}
-        self.bitmaps = {s : bgzip.BGZipWriter(open(self.bgz_fname(s), "wb"))for s in self.steps}
+        #Only needed to build indexes, so not imported by read-only commands
+        import bgzip
 
-        gi = self.anchor_id
-        name = self.anchor_name
+        self._load_kmc(kmc_dbs)
 
-        if self.fasta.endswith(".gz") or self.fasta.endswith(".bgz"):
-            opn = lambda f: gzip.open(f, "rt")
-        else:
-            opn = lambda f: open(f, "r")
-
-        with opn(self.fasta) as fasta:
-        #with open(self.fasta, "r") as fasta:
-            t = time()
-            #for seq_name in fasta.references: 
-            for rec in SeqIO.parse(fasta, "fasta"):
-                seq_name = rec.id
-                seq = str(rec.seq)
-
-                #arrs = list()
-                #arrs_100nt = list()
-                byte_arrs = defaultdict(list)
-
-                def nbytes(i):
-                    if self.nbytes <= 4:
-                        return self.nbytes
-                    elif i == len(self.kmc_dbs)-1 and self.nbytes % 4 > 0:
-                        return self.nbytes % 4
-                    else:
-                        return 4
-
-                sizes = defaultdict(list)
-                for ki,db in enumerate(self.kmc_dbs): 
-                    sys.stdout.flush()
-                    pacbytes = self._get_kmc_counts(db, seq)
-                    pacbytes = pacbytes[:,:nbytes(ki)]
-
-                    for s in self.steps:
-                        a = pacbytes[::s]
-                        byte_arrs[s].append(a)
-                        sizes[s].append(len(a))
-
-                size = None
-                for step,arr in byte_arrs.items():
-                    arr = np.concatenate(arr, axis=1)
-                    self.bitmaps[step].write(arr.tobytes())
-                    self.bitmap_lens[step] += len(arr)
-                    if step == 1:
-                        size = len(arr)
-
-                self.seq_lens[gi][seq_name] = size
-                sys.stdout.write(f"Anchored {seq_name}\n")
-                sys.stdout.flush()
-
-
-                t = time()
+        #The .gzi indexes are written from the block offsets as each file is closed
+        self._bgz_files = {s : BgzfIndexWriter(self.bgz_fname(s), self.idx_fname(s)) for s in self.steps}
+        self.bitmaps = {s : ThreadedWriter(bgzip.BGZipWriter(f)) for s,f in self._bgz_files.items()}
+
+        #KMC queries run one after another in this process. Index.write anchors genomes
+        #in a process pool, and BGZF compression overlaps on the ThreadedWriter threads
+        for seq_name,seq in iter_fasta(self.fasta):
+            #Each DB fills a fixed column slice of the full resolution buffer, which
+            #is then downsampled once per step with all columns in place
+            arr = None
+            for ki,db in enumerate(self.kmc_dbs):
+                pacbytes = self._get_kmc_counts(db, seq)
+                if arr is None:
+                    arr = np.empty((len(pacbytes), self.nbytes), "uint8")
+
+                c0 = ki*4
+                c1 = min(c0+4, self.nbytes)
+                arr[:,c0:c1] = pacbytes[:,:c1-c0]
+
+            ci = self.chrs.get_loc(seq_name)
+            for si,step in enumerate(self.steps):
+                step_arr = arr[::step]
+                self.bitmaps[step].write(step_arr.tobytes())
+                self.seq_lens[ci,si] = len(step_arr)
+
+            sys.stdout.write(f"Anchored {seq_name}\n")
+            sys.stdout.flush()
 
         self.close()
 
-        for step in self.steps:
-            subprocess.check_call([
-                "bgzip", "-rI", self.idx_fname(step), self.bgz_fname(step)])
-
     def close(self):
         if self.bitmaps is not None:
             for f in self.bitmaps.values():
                 f.close()
+
+        #BGZipWriter leaves its output file open
+        for f in getattr(self, "_bgz_files", dict()).values():
+            f.close()
@@ -677,8 +677,9 @@ def view(params):
         return z_genes
 
     def plot_chr_whole( start_coord, end_coord, anchor_name, this_chr, genes): 
-        z_1 = index.chr_bins.loc[anchor_name, ("total",1)][this_chr]
-        z_9 = index.chr_bins.loc[anchor_name, ("total", num_samples)][this_chr]
+        chr_bins = index.query_chr_bins(anchor_name, this_chr)
+        z_1 = chr_bins[:,0]
+        z_9 = chr_bins[:,num_samples-1]
         y, x = [], []
         cntr = 0
         for xtmp in z_1:
@@ -757,11 +758,12 @@ def view(params):
             )
         cntr = 1
         for chrom in index.chrs.loc[anchor_name].index:
-            x = list(index.chr_bins.loc[(anchor_name, chrom)].index)
+            chr_bins = index.query_chr_bins(anchor_name, chrom)
+            x = list(range(0, len(chr_bins)*window_size, window_size))
             if len(x)!=1:
-                wg_fig.append_trace(go.Heatmap(x=x, z=index.chr_bins.loc[anchor_name, ("total",num_samples)][chrom], 
+                wg_fig.append_trace(go.Heatmap(x=x, z=chr_bins[:,num_samples-1], 
                     y=[1]*(len(x)), type = 'heatmap', colorscale='magma_r', showlegend=False,showscale=False), row=((cntr*3)-2), col=1)
-                wg_fig.append_trace(go.Heatmap(x=x, z=index.chr_bins.loc[anchor_name, ("total",1)][chrom], 
+                wg_fig.append_trace(go.Heatmap(x=x, z=chr_bins[:,0], 
                     y=[1]*(len(x)), type = 'heatmap', colorscale='magma', showscale=False), row=((cntr*3)-1), col=1)
             
             if cntr == 1:
@@ -1185,7 +1187,7 @@ def view(params):
         cntr = 0
         if l in index.anchor_genomes:
             for c in index.chrs.loc[l].index:
-                counts = index.chr_bins.loc[(l,c)].sum(axis=0)
+                counts = index.chr_bin_totals.loc[(l,c)]
                 bar_sum_global[l][c] = counts.to_numpy()#bar_sum_global_tmp
                 cntr +=1
 
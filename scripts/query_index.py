@@ -31,7 +31,7 @@ def query_something(ele, chrom):
         e = list()
         i = 0
         while i < index.chrs.loc[anchor_name, chrom]["size"]:
-            e_tmp = index.query_bitmap(anchor_name, chrom, i, i+block_size, skips).sum(axis=1)
+            e_tmp = index.query_occs(anchor_name, chrom, i, i+block_size, skips)
             i += block_size
             e.append(e_tmp)
     elif ele == "custom":